@@ -1,7 +1,10 @@
 import asyncio
+import logging
+import os
 import tempfile
 import zipfile
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from aiogram import Bot, Dispatcher, F
@@ -9,7 +12,10 @@ from aiogram.types import Message, FSInputFile
 from aiogram.filters import CommandStart
 from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN, TEMP_DIR, MAX_FILE_SIZE
+from config import (
+    BOT_TOKEN, TEMP_DIR, MAX_FILE_SIZE, DOWNLOAD_CHUNK_SIZE, MAX_CONCURRENT_JOBS,
+    LOG_FORMAT, LOG_DATE_FORMAT,
+)
 from pdf_assembler import PDFAssembler
 
 
@@ -18,6 +24,10 @@ class PDFBot:
     def __init__(self, token: str):
         self.bot = Bot(token=token)
         self.dp = Dispatcher(storage=MemoryStorage())
+        # Bir vaqtda ishlanadigan ZIPlar soni (RAM cheklovi)
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+        # Fonda o'chirilayotgan vaqtinchalik papkalar (stop() kutadi)
+        self._cleanup_tasks = set()
         self.setup_handlers()
     
     def setup_handlers(self):
@@ -64,6 +74,14 @@ class PDFBot:
             )
             return
         
+        if self._sem.locked():
+            await message.answer("⏳ В очереди...")
+        
+        async with self._sem:
+            await self.process_document(message)
+    
+    async def process_document(self, message: Message):
+        document = message.document
         status_msg = await message.answer("⏳ Загрузка файла...")
         
         temp_id = f"user_{message.from_user.id}_{message.message_id}"
@@ -72,41 +90,63 @@ class PDFBot:
         
         try:
             zip_path = work_dir / document.file_name
-            await self.bot.download(document, zip_path)
+            # Yo'l berilganda aiogram faylni aiofiles orqali bo'laklab yozadi,
+            # butun ZIP xotirada saqlanmaydi
+            await self.bot.download(document, zip_path, chunk_size=DOWNLOAD_CHUNK_SIZE)
             
             await status_msg.edit_text("📦 Распаковка ZIP...")
             
-            input_dir = work_dir / "input"
-            input_dir.mkdir(exist_ok=True)
-            
             try:
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(input_dir)
+                zip_ref = await asyncio.to_thread(zipfile.ZipFile, zip_path, 'r')
             except zipfile.BadZipFile:
                 await status_msg.edit_text("❌ <b>ZIP файл поврежден!</b>", parse_mode="HTML")
                 return
             
-            pdf_files = list(input_dir.rglob("*.pdf"))
-            if len(pdf_files) < 2:
+            with zip_ref:
+                pdf_infos = self._pdf_infos(zip_ref)
+                
+                if len(pdf_infos) < 2:
+                    await status_msg.edit_text(
+                        "❌ <b>Недостаточно файлов!</b>\n\n"
+                        "Нужно минимум 2 PDF:\n"
+                        "• 1 файл этикетки\n"
+                        "• 1+ файл КИЗ",
+                        parse_mode="HTML"
+                    )
+                    return
+                
                 await status_msg.edit_text(
-                    "❌ <b>Недостаточно файлов!</b>\n\n"
-                    "Нужно минимум 2 PDF:\n"
-                    "• 1 файл этикетки\n"
-                    "• 1+ файл КИЗ",
-                    parse_mode="HTML"
+                    f"⚙️ Обработка...\n"
+                    f"📄 Найдено: {len(pdf_infos)} PDF"
                 )
-                return
-            
-            await status_msg.edit_text(
-                f"⚙️ Обработка...\n"
-                f"📄 Найдено: {len(pdf_files)} PDF"
+                
+                # Etiketka (eng katta PDF) central directory'dan aniqlanadi va
+                # KIZ fayllari o'qilayotganda parallel tahlil qilinadi
+                label_info = max(pdf_infos, key=lambda i: i.file_size)
+                kiz_infos = [i for i in pdf_infos if i is not label_info]
+                
+                try:
+                    label_data = await asyncio.to_thread(zip_ref.read, label_info)
+                    
+                    output_dir = work_dir / "output"
+                    assembler = PDFAssembler([(label_info.filename, label_data)], str(output_dir))
+                    
+                    _, kiz_files = await asyncio.gather(
+                        asyncio.to_thread(assembler.find_label_pages, label_info.filename, label_data),
+                        asyncio.to_thread(self._read_entries, zip_ref, kiz_infos),
+                    )
+                except zipfile.BadZipFile:
+                    await status_msg.edit_text("❌ <b>ZIP файл поврежден!</b>", parse_mode="HTML")
+                    return
+            
+            assembler.add_pdf_files(kiz_files)
+            
+            # Tayyor PDFlar diskka emas, to'g'ridan-to'g'ri natija ZIP'iga yoziladi
+            result_zip_path = work_dir / "Сборка_результаты.zip"
+            success, created_files = await asyncio.to_thread(
+                self._assemble_to_zip, assembler, result_zip_path
             )
             
-            output_dir = work_dir / "output"
-            assembler = PDFAssembler(str(input_dir), str(output_dir))
-            
-            success, created_files = assembler.process(create_combined=True)
-            
             if not success or not created_files:
                 await status_msg.edit_text(
                     "❌ <b>Ошибка обработки!</b>\n\n"
@@ -115,14 +155,6 @@ class PDFBot:
                 )
                 return
             
-            await status_msg.edit_text("📦 Создание ZIP архива...")
-            
-            result_zip_path = work_dir / "Сборка_результаты.zip"
-            
-            with zipfile.ZipFile(result_zip_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for file_path in created_files:
-                    zip_file.write(file_path, file_path.name)
-            
             await status_msg.edit_text("📤 Отправка...")
             
             result_file = FSInputFile(
@@ -155,20 +187,52 @@ class PDFBot:
             await message.answer(error_text, parse_mode="HTML")
             
         finally:
-            try:
-                shutil.rmtree(work_dir, ignore_errors=True)
-            except:
-                pass
+            # Foydalanuvchi javobni oldi — o'chirishni kutib o'tirmaymiz
+            task = asyncio.create_task(asyncio.to_thread(shutil.rmtree, work_dir, True))
+            self._cleanup_tasks.add(task)
+            task.add_done_callback(self._cleanup_tasks.discard)
+    
+    @staticmethod
+    def _pdf_infos(zip_ref: zipfile.ZipFile) -> list:
+        # Bitta o'tishda, Path obyektlarisiz: ZIP ichida ajratuvchi doim "/"
+        infos = []
+        for info in zip_ref.infolist():
+            name = info.filename
+            base = name.rpartition('/')[2]
+            if (
+                base.lower().endswith('.pdf')
+                and not base.startswith('._')
+                and '__MACOSX' not in name
+            ):
+                infos.append(info)
+        return infos
+    
+    @staticmethod
+    def _read_entries(zip_ref: zipfile.ZipFile, infos: list) -> list:
+        # PDFlar diskka chiqarilmaydi — to'g'ridan-to'g'ri xotiraga o'qiladi
+        return [(info.filename, zip_ref.read(info)) for info in infos]
+    
+    @staticmethod
+    def _assemble_to_zip(assembler: PDFAssembler, result_zip_path: Path):
+        # PDF oqimlari allaqachon siqilgan — qayta siqish faqat CPU sarfi
+        with zipfile.ZipFile(result_zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
+            return assembler.process(True, emit=zip_file.writestr)
     
     async def start(self):
+        # pypdf ishlari uchun thread pool (event loop bloklanmasin)
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2))
         print("BOT ЗАПУЩЕН")
         await self.dp.start_polling(self.bot)
     
     async def stop(self):
+        if self._cleanup_tasks:
+            await asyncio.gather(*self._cleanup_tasks, return_exceptions=True)
         await self.bot.session.close()
 
 
 async def main():
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
     
     bot = PDFBot(BOT_TOKEN)
     
@@ -10,5 +10,9 @@ SIZE_ORDER = [42, 44, 46, 48, 50, 52, 54, 56]
 
 MAX_FILE_SIZE = 50 * 1024 * 1024 * 1024 * 1024  # 50 GB
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # 64 KB
+
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+
 LOG_FORMAT = "[%(asctime)s] [%(levelname)s] %(message)s"
 LOG_DATE_FORMAT = "%H:%M:%S"
\ No newline at end of file
@@ -1,25 +1,118 @@
+import logging
+import os
 import re
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
-from datetime import datetime
+from typing import Callable, Dict, List, Tuple, Optional
 
-from pypdf import PdfReader, PdfWriter
+import pikepdf
+from pypdf import PdfReader
+
+
+logger = logging.getLogger(__name__)
+
+_SIZE_RE = re.compile(r'Размер:\s*(\d+)')
+_SIZE_WORD_RE = re.compile(r'(\d{2})\s*разм', re.IGNORECASE)
+_OUTPUT_SIZE_RE = re.compile(r'_(\d+)\.pdf$')
+# "Ю 1128 черный 42" — oddiy holat uchun bitta o'tishda tahlil
+_KIZ_RE = re.compile(r'(?P<art1>\S+) (?P<art2>\S+) (?P<color>\S+(?: \S+)*?) (?P<size>\d+)')
+
+
+class _SizeFound(Exception):
+    """Etiketka sahifasida o'lcham topilganda matn chiqarishni to'xtatadi."""
+
+
+def assemble_pdf_for_size(
+    label_data: bytes,
+    tovar_page: int,
+    qadoq_page: int,
+    kiz_data: bytes
+) -> Tuple[int, bytes]:
+    """
+    Bitta o'lcham uchun PDF yig'adi: har bir KIZ sahifasi uchun
+    tovar + qadoq + KIZ + KIZ. Alohida jarayonda ishlashi uchun
+    modul darajasida (picklable) va etiketkani o'zi ochadi.
+    Sahifalar soni va PDF baytlarini qaytaradi (diskka yozilmaydi).
+    """
+    # Yozish qpdf (pikepdf) orqali: sahifalar havola bilan ko'chiriladi,
+    # etiketka resurslari takrorlanmaydi
+    with pikepdf.open(BytesIO(label_data)) as label_pdf, \
+            pikepdf.open(BytesIO(kiz_data)) as kiz_pdf, \
+            pikepdf.new() as out:
+        # Sahifalar sikldan oldin bir marta ko'chiriladi, so'ng faqat yangi
+        # /Page lug'atlari yaratilib /Kids bir martada yoziladi
+        # (pages.append har chaqiruvda sahifalar daraxtini qayta ko'radi)
+        pages_root = out.Root.Pages
+        tovar_page_obj = out.copy_foreign(label_pdf.pages[tovar_page].obj)
+        qadoq_page_obj = out.copy_foreign(label_pdf.pages[qadoq_page].obj)
+        
+        kids = []
+        for kiz_page in list(kiz_pdf.pages):
+            kiz_page_obj = out.copy_foreign(kiz_page.obj)
+            for page_obj in (tovar_page_obj, qadoq_page_obj, kiz_page_obj, kiz_page_obj):
+                page_dict = pikepdf.Dictionary(page_obj)
+                page_dict.Parent = pages_root
+                kids.append(out.make_indirect(page_dict))
+        
+        pages_root.Kids = pikepdf.Array(kids)
+        pages_root.Count = len(kids)
+        
+        buffer = BytesIO()
+        out.save(buffer, linearize=False)
+        total_pages = len(kids)
+    
+    return total_pages, buffer.getvalue()
+
+
+# Worker jarayonidagi etiketka baytlari: har bir vazifaga emas, jarayonga
+# bir marta beriladi (fork'da nusxa olinmaydi, xotira umumiy qoladi)
+_worker_label_data: Optional[bytes] = None
+
+
+def _init_worker(label_data: bytes) -> None:
+    global _worker_label_data
+    _worker_label_data = label_data
+
+
+def _assemble_one(
+    task: Tuple[int, int, bytes]
+) -> Tuple[int, bytes, Optional[str]]:
+    try:
+        pages, data = assemble_pdf_for_size(_worker_label_data, *task)
+        return pages, data, None
+    except Exception as e:
+        return 0, b"", str(e)
 
 
 class PDFAssembler:
     
-    def __init__(self, input_dir: str, output_dir: str):
-        self.input_dir = Path(input_dir)
+    def __init__(self, pdf_files: List[Tuple[str, bytes]], output_dir: str):
+        """
+        pdf_files — ZIP ichidagi PDF nomlari va ularning baytlari
+        (diskka chiqarilmaydi).
+        """
+        self.pdf_files = []
+        self.add_pdf_files(pdf_files)
         self.output_dir = Path(output_dir)
         self.log_messages = []
         self.size_order = [42, 44, 46, 48, 50, 52, 54, 56]   # qat’iy tartib
-        self.output_dir.mkdir(exist_ok=True)
+        self._size_set = frozenset(self.size_order)          # a'zolik tekshiruvi uchun
+        self._label_pages_cache: Dict[str, Dict[int, Tuple[int, int]]] = {}
         
+    def add_pdf_files(self, pdf_files: List[Tuple[str, bytes]]):
+        self.pdf_files.extend((Path(name), data) for name, data in pdf_files)
+    
+    def write_output(self, name: str, data: bytes):
+        self.output_dir.mkdir(exist_ok=True)
+        (self.output_dir / name).write_bytes(data)
+    
     def log(self, message: str, level: str = "INFO"):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] [{level}] {message}"
-        self.log_messages.append(log_entry)
-        print(log_entry)
+        levelno = logging.getLevelName(level)
+        if not logger.isEnabledFor(levelno):
+            return
+        self.log_messages.append(f"[{level}] {message}")
+        logger.log(levelno, message)
     
     def get_log_text(self) -> str:
         return '\n'.join(self.log_messages)
@@ -32,16 +125,48 @@ class PDFAssembler:
             return ""
     
     def find_size_in_text(self, text: str) -> Optional[int]:
-        match = re.search(r'Размер:\s*(\d+)', text)
+        match = _SIZE_RE.search(text)
         if match:
             return int(match.group(1))
         return None
     
-    def find_label_pages(self, label_file_path: Path) -> Dict[int, Tuple[int, int]]:
-        self.log(f"📄 Etiketka fayli: {label_file_path.name}")
+    def find_size_in_page(self, page) -> Optional[int]:
+        """
+        Sahifadan o'lchamni topadi. "Размер:" odatda sahifa boshida bo'ladi,
+        shuning uchun topilishi bilan qolgan matn chiqarilmaydi.
+        """
+        chunks = []
+        found = {}
+        
+        def visitor(text, cm, tm, font_dict, font_size):
+            if not text:
+                return
+            chunks.append(text)
+            tail = "".join(chunks[-4:])
+            match = _SIZE_RE.search(tail)
+            # raqam keyingi bo'lakda davom etishi mumkin
+            if match and match.end() < len(tail):
+                found["size"] = int(match.group(1))
+                raise _SizeFound
         
         try:
-            reader = PdfReader(label_file_path)
+            page.extract_text(visitor_text=visitor)
+        except _SizeFound:
+            return found["size"]
+        except Exception as e:
+            self.log(f"Matn chiqarishda xatolik: {e}", "WARNING")
+        
+        return self.find_size_in_text("".join(chunks))
+    
+    def find_label_pages(self, label_name: str, label_data: bytes) -> Dict[int, Tuple[int, int]]:
+        label_name = str(Path(label_name))
+        if label_name in self._label_pages_cache:
+            return self._label_pages_cache[label_name]
+        
+        self.log(f"📄 Etiketka fayli: {Path(label_name).name}")
+        
+        try:
+            reader = PdfReader(BytesIO(label_data), strict=False)
             total_pages = len(reader.pages)
             self.log(f"   Jami {total_pages} sahifa")
             
@@ -50,13 +175,12 @@ class PDFAssembler:
             first_page = None
             
             for page_num, page in enumerate(reader.pages):
-                text = self.extract_text_from_page(page)
-                size = self.find_size_in_text(text)
+                size = self.find_size_in_page(page)
                 
                 if size:
                     if current_size == size and first_page is not None:
                         size_pages[size] = (first_page, page_num)
-                        self.log(f"   ✓ O'lcham {size}: sahifa {first_page}+{page_num}")
+                        self.log(f"   ✓ O'lcham {size}: sahifa {first_page}+{page_num}", "DEBUG")
                         current_size = None
                         first_page = None
                     else:
@@ -65,7 +189,11 @@ class PDFAssembler:
             
             if not size_pages:
                 self.log("⚠️ Hech qanday o'lcham topilmadi!", "WARNING")
+            else:
+                sizes = ", ".join(str(size) for size in sorted(size_pages))
+                self.log(f"   ✓ O'lchamlar ({len(size_pages)} ta): {sizes}")
             
+            self._label_pages_cache[label_name] = size_pages
             return size_pages
             
         except Exception as e:
@@ -82,6 +210,25 @@ class PDFAssembler:
         Agar size bo‘lmasa — avtomatik fallback ishlaydi (pastda).
         """
         name = Path(filename).stem
+        
+        # Tezkor yo'l: "artikul artikul rang... o'lcham". Natija pastdagi
+        # umumiy yo'l bilan bir xil bo'lmasa (o'lcham takrorlansa va h.k.)
+        # umumiy yo'lga tushamiz
+        m = _KIZ_RE.fullmatch(name)
+        if m:
+            size = m["size"]
+            if (
+                int(size) in self._size_set
+                and size == str(int(size))
+                and size not in (m["art1"], m["art2"])
+                and f" {size} " not in f" {m['color']} "
+            ):
+                return {
+                    "article": f"{m['art1']} {m['art2']}",
+                    "color": m["color"],
+                    "size": size,
+                }
+        
         parts = name.split()
         
         size = ""
@@ -90,16 +237,16 @@ class PDFAssembler:
         for part in reversed(parts):
             if part.isdigit():
                 num = int(part)
-                if num in self.size_order:
+                if num in self._size_set:
                     size = str(num)
                     break
         
         # 2) "56 размер" kabi format
         if not size:
-            m = re.search(r'(\d{2})\s*разм', name, re.IGNORECASE)
+            m = _SIZE_WORD_RE.search(name)
             if m:
                 num = int(m.group(1))
-                if num in self.size_order:
+                if num in self._size_set:
                     size = str(num)
         
         # Article + color
@@ -123,74 +270,62 @@ class PDFAssembler:
         
         return {"article": article, "color": color, "size": size}
     
-    def assemble_pdf_for_size(
-        self,
-        label_reader: PdfReader,
-        tovar_page: int,
-        qadoq_page: int,
-        kiz_file_path: Path,
-        output_path: Path
-    ) -> int:
-        try:
-            kiz_reader = PdfReader(kiz_file_path)
-            kiz_page_count = len(kiz_reader.pages)
-            
-            self.log(f"   📦 KIZ: {kiz_file_path.name} ({kiz_page_count} dona)")
-            
-            writer = PdfWriter()
-            tovar_page_obj = label_reader.pages[tovar_page]
-            qadoq_page_obj = label_reader.pages[qadoq_page]
-            
-            for kiz_page in kiz_reader.pages:
-                writer.add_page(tovar_page_obj)
-                writer.add_page(qadoq_page_obj)
-                writer.add_page(kiz_page)
-                writer.add_page(kiz_page)
-            
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
-            
-            total_pages = kiz_page_count * 4
-            self.log(f"   ✅ Tayyor: {output_path.name} ({total_pages} sahifa)")
-            
-            return total_pages
-            
-        except Exception as e:
-            self.log(f"   ❌ Xatolik: {e}", "ERROR")
-            return 0
-    
-    def create_combined_pdf(self, individual_files: List[Path], output_path: Path):
+    def create_combined_pdf(self, individual_pdfs: Dict[str, bytes], output_name: str) -> Optional[bytes]:
+        """
+        individual_pdfs — yig'ilgan fayl nomi va uning xotiradagi baytlari,
+        diskdan qayta o'qimaslik uchun. Umumiy PDF baytlarini qaytaradi.
+        """
         try:
             self.log("🔗 Umumiy fayl yaratilmoqda...")
             
-            writer = PdfWriter()
-            total_pages = 0
+            sources = []
+            
+            # bir o'lchamda bir nechta rang bo'lishi mumkin
+            by_size: Dict[int, List[Tuple[str, bytes]]] = {}
+            for name, data in individual_pdfs.items():
+                if (m := _OUTPUT_SIZE_RE.search(name)):
+                    by_size.setdefault(int(m.group(1)), []).append((name, data))
             
-            for size in self.size_order:
-                for file_path in individual_files:
-                    if f"_{size}.pdf" in str(file_path):
-                        reader = PdfReader(file_path)
-                        for page in reader.pages:
-                            writer.add_page(page)
-                        total_pages += len(reader.pages)
-                        self.log(f"   + {file_path.name}")
+            with pikepdf.new() as out:
+                for size in self.size_order:
+                    for name, data in by_size.get(size, []):
+                        src = pikepdf.open(BytesIO(data))
+                        sources.append(src)
+                        out.pages.extend(src.pages)
+                        self.log(f"   + {name}")
+                
+                total_pages = len(out.pages)
+                # manbalar save() tugaguncha ochiq turishi kerak
+                buffer = BytesIO()
+                out.save(buffer, linearize=False)
             
-            with open(output_path, 'wb') as output_file:
-                writer.write(output_file)
+            for src in sources:
+                src.close()
             
-            self.log(f"✅ Umumiy fayl: {output_path.name} ({total_pages} sahifa)")
+            self.log(f"✅ Umumiy fayl: {output_name} ({total_pages} sahifa)")
+            return buffer.getvalue()
             
         except Exception as e:
             self.log(f"❌ Xatolik: {e}", "ERROR")
+            return None
     
-    def process(self, create_combined: bool = True):
+    def process(
+        self,
+        create_combined: bool = True,
+        emit: Optional[Callable[[str, bytes], None]] = None
+    ):
+        """
+        emit(nom, baytlar) — har bir tayyor PDF shu yerga beriladi
+        (masalan, natija ZIP'iga to'g'ridan-to'g'ri yozish uchun).
+        Berilmasa, fayllar output_dir ga yoziladi.
+        Qaytaradi: (muvaffaqiyat, yaratilgan fayl nomlari).
+        """
+        if emit is None:
+            emit = self.write_output
         
-        # 1) Hamma PDFlarni topamiz
-        all_pdfs = list(self.input_dir.rglob("*.pdf"))
-
-        # MacOS keraksiz fayllarni tashlab yuboramiz
+        # 1) MacOS keraksiz fayllarni tashlab yuboramiz
         all_pdfs = [
-            f for f in all_pdfs
+            (f, data) for f, data in self.pdf_files
             if "__MACOSX" not in f.parts and not f.name.startswith("._")
         ]
 
@@ -199,15 +334,14 @@ class PDFAssembler:
             return False, []
 
         # 2) Eng katta pdf — etiketka
-        label_file = max(all_pdfs, key=lambda f: f.stat().st_size)
+        label_file, label_data = max(all_pdfs, key=lambda f: len(f[1]))
         self.log(f"📄 Etiketka fayli tanlandi: {label_file.name}")
 
-        kiz_files = [f for f in all_pdfs if f != label_file]
+        kiz_files = [f for f in all_pdfs if f[0] != label_file]
         self.log(f"📂 KIZ fayllari: {len(kiz_files)} ta\n")
 
         # 3) Etiketka sahifalari
-        label_reader = PdfReader(label_file)
-        size_pages = self.find_label_pages(label_file)
+        size_pages = self.find_label_pages(str(label_file), label_data)
 
         if not size_pages:
             self.log("❌ Etiketka sahifalari topilmadi!", "ERROR")
@@ -220,10 +354,10 @@ class PDFAssembler:
         kiz_infos = []
         known_sizes = set()
 
-        for f in sorted(kiz_files):
+        for f, data in sorted(kiz_files, key=lambda f: f[0]):
             info = self.extract_kiz_info(f.name)
             s = int(info["size"]) if info["size"].isdigit() else None
-            kiz_infos.append({"file": f, "info": info, "size": s})
+            kiz_infos.append({"file": f, "data": data, "info": info, "size": s})
             if s:
                 known_sizes.add(s)
 
@@ -242,8 +376,9 @@ class PDFAssembler:
                 for item in unknown_items:
                     self.log(f"⚠️ {item['file'].name} uchun size topilmadi!", "WARNING")
 
-        # 6) Yig‘ish
-        created_files = []
+        # 6) Yig‘ish (har bir o'lcham alohida jarayonda)
+        tasks = []
+        assembled = []
 
         for item in kiz_infos:
             kiz_file = item["file"]
@@ -257,23 +392,41 @@ class PDFAssembler:
                 color_safe = (info["color"] or "NOCOLOR").strip()
 
                 output_filename = f"Сборка_{article_safe}_{color_safe}_{size}.pdf"
-                output_path = self.output_dir / output_filename
 
-                pages = self.assemble_pdf_for_size(
-                    label_reader, tovar_page, qadoq_page, kiz_file, output_path
-                )
-
-                if pages > 0:
-                    created_files.append(output_path)
+                assembled.append((item, output_filename))
+                tasks.append((tovar_page, qadoq_page, item["data"]))
             else:
                 self.log(f"⚠️ {kiz_file.name} uchun etiketka topilmadi!", "WARNING")
 
+        created_files = []
+        created_data = {}
+
+        if tasks:
+            max_workers = min(len(tasks), os.cpu_count() or 1)
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(label_data,)
+            ) as executor:
+                results = list(executor.map(_assemble_one, tasks))
+
+            for (item, output_filename), (pages, data, error) in zip(assembled, results):
+                self.log(f"   📦 KIZ: {item['file'].name} ({pages // 4} dona)")
+                if error:
+                    self.log(f"   ❌ Xatolik: {error}", "ERROR")
+                elif pages > 0:
+                    self.log(f"   ✅ Tayyor: {output_filename} ({pages} sahifa)")
+                    emit(output_filename, data)
+                    created_files.append(output_filename)
+                    created_data[output_filename] = data
+
         # 7) Bitta umumiy pdf
         if create_combined and created_files:
             first = kiz_infos[0]["info"]
             combined_name = f"Сборка_{first['article'].replace(' ', '')}_{first['color']}_все_размеры.pdf"
-            combined_path = self.output_dir / combined_name
-            self.create_combined_pdf(created_files, combined_path)
-            created_files.append(combined_path)
+            combined_data = self.create_combined_pdf(created_data, combined_name)
+            if combined_data is not None:
+                emit(combined_name, combined_data)
+                created_files.append(combined_name)
 
         return True, created_files